@@ -1,7 +1,10 @@
 import datetime
+import errno
+import hashlib
 import io
 import json
 import os
+import shutil
 import tempfile
 import time
 from pathlib import Path
@@ -39,10 +42,34 @@ from llama_index import (
     download_loader,
     load_index_from_storage,
 )
+from llama_index.embeddings.openai import OpenAIEmbedding
 from llama_index.llm_predictor.chatgpt import ChatGPTLLMPredictor
+from llama_index.storage.docstore import SimpleDocumentStore
+from llama_index.storage.storage_context import VECTOR_STORE_FNAME
 from llama_index.vector_stores.faiss import FaissVectorStore
 from streamlit_lottie import st_lottie, st_lottie_spinner
 
+# ワーカープロセス間で共有するインデックスの保存先
+INDEX_DIR = "./storage/indexes"
+INDEX_MANIFEST = "manifest.json"
+INDEX_DOCUMENTS = "documents.json"
+INDEX_VERSION = 2
+# 保存したインデックスの保持期間(最終利用からの日数)と合計サイズの上限
+INDEX_MAX_AGE_DAYS = float(os.environ.get("INDEX_MAX_AGE_DAYS", 7))
+INDEX_MAX_BYTES = int(os.environ.get("INDEX_MAX_BYTES", 1024**3))
+# 作成途中・削除途中のディレクトリを残骸とみなすまでの秒数
+INDEX_STALE_SECONDS = 3600
+EMBED_MODEL = "text-embedding-ada-002"
+# dimensions of text-ada-embedding-002
+EMBED_DIM = 1536
+CHUNK_SIZE_LIMIT = 512
+# ベクトルに影響する設定。異なる場合は保存済みインデックスを再利用しない
+INDEX_SETTINGS = {
+    "embed_model": EMBED_MODEL,
+    "dimension": EMBED_DIM,
+    "chunk_size_limit": CHUNK_SIZE_LIMIT,
+}
+
 
 # promptsの出力を行わないためラップ
 class WrapStreamlitCallbackHandler(StreamlitCallbackHandler):
@@ -70,8 +97,229 @@ def load_lottieurl(url: str):
     return r.json()
 
 
-def make_query_engine(data, llm, reading, name):
+def index_key(name, content):
+    # 入力内容と設定からインデックスのキーを作成。設定ごとに別ディレクトリとなる
+    config = json.dumps(
+        {"version": INDEX_VERSION, "settings": INDEX_SETTINGS}, sort_keys=True
+    )
+    h = hashlib.sha256()
+    for part in [config.encode("utf-8"), name.encode("utf-8"), content]:
+        # 区切りが曖昧にならないよう長さを先頭に付ける
+        h.update(len(part).to_bytes(8, "big"))
+        h.update(part)
+    return h.hexdigest()
+
+
+def to_mmap_index(faiss_index):
+    # メモリマップで読み込めるよう、全件探索のIVF(nlist=1)に詰め替える
+    vectors = faiss_index.reconstruct_n(0, faiss_index.ntotal)
+    quantizer = faiss.IndexFlatIP(faiss_index.d)
+    ivf_index = faiss.IndexIVFFlat(
+        quantizer, faiss_index.d, 1, faiss.METRIC_INNER_PRODUCT
+    )
+    ivf_index.train(vectors)
+    ivf_index.add(vectors)
+    return ivf_index
+
+
+def discard_index(persist_dir):
+    # 退避してから削除し、他プロセスに削除途中の状態を見せない
+    # 削除に失敗しても再作成すればよいため、エラーは記録のみ
+    trash_dir = None
+    try:
+        trash_dir = tempfile.mkdtemp(prefix=".trash-", dir=INDEX_DIR)
+        os.rename(persist_dir, os.path.join(trash_dir, "index"))
+    except FileNotFoundError:
+        pass
+    except OSError as e:
+        print(f"インデックスの削除に失敗しました。：{persist_dir} {e}")
+    if trash_dir:
+        shutil.rmtree(trash_dir, ignore_errors=True)
+
+
+def prune_indexes(keep):
+    # 最終利用が古いもの、合計サイズの上限を超えたものから削除
+    now = time.time()
+    entries = []
+    for entry in os.scandir(INDEX_DIR):
+        try:
+            if not entry.is_dir():
+                continue
+            if entry.name.startswith("."):
+                if now - entry.stat().st_mtime > INDEX_STALE_SECONDS:
+                    shutil.rmtree(entry.path, ignore_errors=True)
+                continue
+            try:
+                last_used = os.stat(os.path.join(entry.path, INDEX_MANIFEST)).st_mtime
+            except FileNotFoundError:
+                last_used = entry.stat().st_mtime
+            size = sum(f.stat().st_size for f in os.scandir(entry.path) if f.is_file())
+        except FileNotFoundError:
+            continue
+        entries.append((last_used, size, entry.path))
+
+    keep = os.path.abspath(keep)
+    total = sum(size for _, size, path in entries if os.path.abspath(path) == keep)
+    for last_used, size, path in sorted(entries, reverse=True):
+        if os.path.abspath(path) == keep:
+            continue
+        expired = now - last_used > INDEX_MAX_AGE_DAYS * 86400
+        if expired or total + size > INDEX_MAX_BYTES:
+            discard_index(path)
+        else:
+            total += size
+
+
+def save_index(index, faiss_index, documents, persist_dir, name):
+    # 一時ディレクトリに書き出してからリネームし、他プロセスに途中状態を見せない
+    os.makedirs(INDEX_DIR, exist_ok=True)
+    tmp_dir = tempfile.mkdtemp(prefix=".build-", dir=INDEX_DIR)
+    try:
+        index.storage_context.persist(persist_dir=tmp_dir)
+        if faiss_index.ntotal:
+            faiss.write_index(
+                to_mmap_index(faiss_index), os.path.join(tmp_dir, VECTOR_STORE_FNAME)
+            )
+
+        docstore = SimpleDocumentStore()
+        docstore.add_documents(documents)
+        docstore.persist(persist_path=os.path.join(tmp_dir, INDEX_DOCUMENTS))
+
+        manifest = {
+            "version": INDEX_VERSION,
+            "settings": INDEX_SETTINGS,
+            "name": name,
+            "ntotal": faiss_index.ntotal,
+            "doc_ids": [document.doc_id for document in documents],
+            "created_at": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        }
+        with open(os.path.join(tmp_dir, INDEX_MANIFEST), "w", encoding="utf-8") as f:
+            json.dump(manifest, f, ensure_ascii=False)
+
+        try:
+            os.rename(tmp_dir, persist_dir)
+        except OSError as e:
+            # 別プロセスが先に保存済みの場合はそちらを使う
+            if e.errno not in (errno.EEXIST, errno.ENOTEMPTY):
+                raise
+        prune_indexes(keep=persist_dir)
+    except Exception as e:
+        print(f"インデックスの保存に失敗しました。：{persist_dir} {e}")
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+def read_manifest(persist_dir):
+    # 欠落・破損・不整合はValueError(またはFileNotFoundError)とし、
+    # それ以外のOSErrorは一時的な失敗としてそのまま送出する
+    with open(os.path.join(persist_dir, INDEX_MANIFEST), encoding="utf-8") as f:
+        manifest = json.load(f)
+    if not isinstance(manifest, dict):
+        raise ValueError("manifest is not an object")
+    if manifest.get("version") != INDEX_VERSION:
+        raise ValueError("manifest version mismatch")
+    if manifest.get("settings") != INDEX_SETTINGS:
+        raise ValueError("manifest settings mismatch")
+    return manifest
+
+
+def attach_index(persist_dir, manifest, service_context):
+    # 読み取り専用のメモリマップで開き、ページキャッシュをプロセス間で共有する
+    vector_path = os.path.join(persist_dir, VECTOR_STORE_FNAME)
+    if manifest["ntotal"]:
+        faiss_index = faiss.read_index(
+            vector_path, faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY
+        )
+    else:
+        faiss_index = faiss.IndexFlatIP(EMBED_DIM)
+    if faiss_index.d != EMBED_DIM or faiss_index.ntotal != manifest["ntotal"]:
+        raise ValueError("vector store does not match manifest")
+    vector_store = FaissVectorStore(faiss_index=faiss_index)
+    storage_context = StorageContext.from_defaults(
+        vector_store=vector_store, persist_dir=persist_dir
+    )
+    index = load_index_from_storage(storage_context, service_context=service_context)
+
+    docstore = SimpleDocumentStore.from_persist_path(
+        os.path.join(persist_dir, INDEX_DOCUMENTS)
+    )
+    documents = [docstore.get_document(doc_id) for doc_id in manifest["doc_ids"]]
+    return index, documents
+
+
+def open_index(persist_dir, service_context):
+    # 保存済みのインデックスに接続。壊れている場合は削除して再作成させる
+    if not os.path.isdir(persist_dir):
+        return None
+    try:
+        manifest = read_manifest(persist_dir)
+        index, documents = attach_index(persist_dir, manifest, service_context)
+    except (FileNotFoundError, ValueError, KeyError, RuntimeError) as e:
+        print(f"インデックスが破損しています。再作成します。：{persist_dir} {e}")
+        discard_index(persist_dir)
+        return None
+    except Exception as e:
+        # 一時的な失敗では他プロセスが使用中のインデックスを消さない
+        print(f"インデックスの読み込みに失敗しました。：{persist_dir} {e}")
+        return None
+    # 最終利用日時として記録
+    try:
+        os.utime(os.path.join(persist_dir, INDEX_MANIFEST))
+    except OSError:
+        pass
+    return index, documents
+
+
+def load_documents(data, name):
     check_name = name.lower()
+    if ".pdf" in check_name:
+        PDFReader = download_loader("PDFReader")
+        loader = PDFReader()
+        documents = loader.load_data(file=data)
+    elif any([".txt" in check_name, ".md" in name]):
+        MarkdownReader = download_loader("MarkdownReader")
+        loader = MarkdownReader()
+        documents = loader.load_data(file=data)
+    elif ".pptx" in check_name:
+        PptxReader = download_loader("PptxReader")
+        loader = PptxReader()
+        documents = loader.load_data(file=data)
+    elif ".docx" in check_name:
+        DocxReader = download_loader("DocxReader")
+        loader = DocxReader()
+        documents = loader.load_data(file=data)
+    elif any([".mp3" in check_name, ".mp4" in check_name]):
+        AudioTranscriber = download_loader("AudioTranscriber")
+        loader = AudioTranscriber()
+        documents = loader.load_data(file=data)
+    elif ".csv" in check_name:
+        PandasCSVReader = download_loader("PandasCSVReader")
+        loader = PandasCSVReader()
+        documents = loader.load_data(file=data)
+    elif "youtu" in check_name:
+        YoutubeTranscriptReader = download_loader("YoutubeTranscriptReader")
+        loader = YoutubeTranscriptReader()
+        documents = loader.load_data(ytlinks=[name])
+    elif "http" in check_name:
+        BeautifulSoupWebReader = download_loader("BeautifulSoupWebReader")
+        loader = BeautifulSoupWebReader()
+        documents = loader.load_data(urls=[name])
+    # elif ext in [".png", ".jpeg", ".jpg"]:
+    #     ImageCaptionReader = download_loader("ImageCaptionReader")
+    #     loader = ImageCaptionReader()
+    #     documents = loader.load_data(file=data)
+    else:
+        try:
+            MarkdownReader = download_loader("MarkdownReader")
+            loader = MarkdownReader()
+            documents = loader.load_data(file=data)
+        except:
+            st.error(f"非対応のファイル形式です。：{name}")
+            st.stop()
+    return documents
+
+
+def make_query_engine(data, llm, reading, name):
     if reading:
         # インデックスの読み込み
         storage_context = StorageContext.from_defaults(persist_dir="./storage")
@@ -83,66 +331,41 @@ def make_query_engine(data, llm, reading, name):
         llm_predictor = ChatGPTLLMPredictor(llm=llm)
         service_context = ServiceContext.from_defaults(
             llm_predictor=llm_predictor,
+            embed_model=OpenAIEmbedding(model=EMBED_MODEL),
             prompt_helper=prompt_helper,
-            chunk_size_limit=512,
+            chunk_size_limit=CHUNK_SIZE_LIMIT,
         )
-        if ".pdf" in check_name:
-            PDFReader = download_loader("PDFReader")
-            loader = PDFReader()
-            documents = loader.load_data(file=data)
-        elif any([".txt" in check_name, ".md" in name]):
-            MarkdownReader = download_loader("MarkdownReader")
-            loader = MarkdownReader()
-            documents = loader.load_data(file=data)
-        elif ".pptx" in check_name:
-            PptxReader = download_loader("PptxReader")
-            loader = PptxReader()
-            documents = loader.load_data(file=data)
-        elif ".docx" in check_name:
-            DocxReader = download_loader("DocxReader")
-            loader = DocxReader()
-            documents = loader.load_data(file=data)
-        elif any([".mp3" in check_name, ".mp4" in check_name]):
-            AudioTranscriber = download_loader("AudioTranscriber")
-            loader = AudioTranscriber()
-            documents = loader.load_data(file=data)
-        elif ".csv" in check_name:
-            PandasCSVReader = download_loader("PandasCSVReader")
-            loader = PandasCSVReader()
-            documents = loader.load_data(file=data)
-        elif "youtu" in check_name:
-            YoutubeTranscriptReader = download_loader("YoutubeTranscriptReader")
-            loader = YoutubeTranscriptReader()
-            documents = loader.load_data(ytlinks=[name])
-        elif "http" in check_name:
-            BeautifulSoupWebReader = download_loader("BeautifulSoupWebReader")
-            loader = BeautifulSoupWebReader()
-            documents = loader.load_data(urls=[name])
-        # elif ext in [".png", ".jpeg", ".jpg"]:
-        #     ImageCaptionReader = download_loader("ImageCaptionReader")
-        #     loader = ImageCaptionReader()
-        #     documents = loader.load_data(file=data)
+        if isinstance(data, Path):
+            documents = None
+            content = data.read_bytes()
         else:
-            try:
-                MarkdownReader = download_loader("MarkdownReader")
-                loader = MarkdownReader()
-                documents = loader.load_data(file=data)
-            except:
-                st.error(f"非対応のファイル形式です。：{name}")
-                st.stop()
-
-        # dimensions of text-ada-embedding-002
-        d = 1536
-        # コサイン類似度
-        faiss_index = faiss.IndexFlatIP(d)
-        vector_store = FaissVectorStore(faiss_index=faiss_index)
-        storage_context = StorageContext.from_defaults(vector_store=vector_store)
-
-        index = GPTVectorStoreIndex.from_documents(
-            documents, faiss_index=faiss_index, service_context=service_context
-        )
-        # インデックスの保存
-        # index.storage_context.persist()
+            # Web・Youtubeは毎回取得し、取得した内容でキーを作る
+            documents = load_documents(data, name)
+            content = "".join(document.text for document in documents).encode("utf-8")
+        persist_dir = os.path.join(INDEX_DIR, index_key(name, content))
+
+        opened = open_index(persist_dir, service_context)
+        if opened:
+            index, documents = opened
+        else:
+            if documents is None:
+                documents = load_documents(data, name)
+
+            # コサイン類似度
+            faiss_index = faiss.IndexFlatIP(EMBED_DIM)
+            vector_store = FaissVectorStore(faiss_index=faiss_index)
+            storage_context = StorageContext.from_defaults(vector_store=vector_store)
+
+            index = GPTVectorStoreIndex.from_documents(
+                documents,
+                storage_context=storage_context,
+                service_context=service_context,
+            )
+            # インデックスを保存し、作成したプロセスもメモリマップ側を使う
+            save_index(index, faiss_index, documents, persist_dir, name)
+            opened = open_index(persist_dir, service_context)
+            if opened:
+                index, documents = opened
 
     query_engine = index.as_query_engine(
         similarity_top_k=3,